@@ -7,12 +7,53 @@ https://pro.arcgis.com/en/pro-app/latest/arcpy/main/arcgis-pro-arcpy-reference.h
 """
 
 import os
+import re
 import sys
-import time
 import csv
+import shelve
+import functools
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import arcpy
-from bs4 import BeautifulSoup
+
+try:
+    import aiohttp
+except ImportError:
+    # Not in the stock ArcGIS Pro environment, transform falls back to a thread pool.
+    aiohttp = None
+
+# Log the per point geoid18 request and parse messages.
+_VERBOSE = False
+
+# Default number of requests in flight to noaa geoid18 calculator.
+_MAX_REQUESTS = 16
+
+# Shared session so requests to noaa geoid18 calculator reuse pooled keep-alive connections,
+# used by postprocess_geoid18 and the transform thread pool fallback.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_maxsize=_MAX_REQUESTS))
+
+# Url of the noaa geoid18 calculator for a single point, formatted with (lat, long).
+_URL = 'https://geodesy.noaa.gov/cgi-bin/GEOID_STUFF/geoid18_single.prl?PGM=intg&MODEL=14&LAT=%s&LONG=%s&longitude_direction=2'
+
+# Body of the <pre> block holding the results in a noaa geoid18 calculator response.
+_PRE_RE = re.compile(rb'<pre[^>]*>(.*?)</pre>', re.DOTALL)
+
+# Geoprocessing result status names indexed by result.status.
+_STATUS_CODE = ('New', 'Submitted', 'Waiting', 'Executing', 'Succeeded', 'Failed',
+                'Timed Out', 'Canceling', 'Canceled', 'Deleting', 'Deleted')
+
+# Number of rows buffered before each write to orthometric_R10Points.csv.
+_BATCH_SIZE = 1000
+
+# Columns of orthometric_R10Points.csv, R10Points.csv has all but the last two.
+_FIELDNAMES = ('Name', 'Ortho_Measured', 'ReceiverName', 'HorizontalAccuracy', 'VerticalAccuracy',
+               'Latitude', 'Longitude', 'Elevation', 'NumberSatellites', 'FixTime', 'Measured_Ortho',
+               'Calculated_Ortho')
+_IDX = {name: i for i, name in enumerate(_FIELDNAMES)}
 
 
 def pwd():
@@ -86,18 +127,9 @@ def check_status(result):
     Returns:
         Requires futher investigation on what result.getMessages() means on return.
     """
-    status_code = dict([(0, 'New'), (1, 'Submitted'), (2, 'Waiting'),
-                        (3, 'Executing'), (4, 'Succeeded'), (5, 'Failed'),
-                        (6, 'Timed Out'), (7, 'Canceling'), (8, 'Canceled'),
-                        (9, 'Deleting'), (10, 'Deleted')])
-
     arcpy.AddMessage('current job status: {0}-{1}'.format(
-        result.status, status_code[result.status]))
-    # Wait until the tool completes
-    while result.status < 4:
-        arcpy.AddMessage('current job status (in while loop): {0}-{1}'.format(
-            result.status, status_code[result.status]))
-        time.sleep(0.2)
+        result.status, _STATUS_CODE[result.status]))
+    # Synchronous tool calls return a completed result, getMessages() blocks otherwise.
     messages = result.getMessages()
     arcpy.AddMessage('job messages: {0}'.format(messages))
     return messages
@@ -110,24 +142,111 @@ def parse_geoid18_response(html):
     https://geodesy.noaa.gov/GEOID/GEOID18/computation.html
 
     Arguments:
-        html: Valid html page from a successful response from noaa geoid18 calculator
+        html: Bytes of a valid html page from a successful response from noaa geoid18 calculator
     Returns:
         Geoid undulation N and the error e
+    Raises:
+        ValueError: The page has no <pre> block of results.
     """
-    soup = BeautifulSoup(html, 'html.parser')
-    n = soup.pre.string
-    lines = n.split('\n')
-    data = lines[3].split()
+    m = _PRE_RE.search(html)
+    if m is None:
+        raise ValueError(f'no <pre> block in noaa geoid18 response: {html[:200]!r}')
+    data = m.group(1).split(b'\n')[3].split()
     n = float(data[-2])
     e = float(data[-1])
-    arcpy.AddMessage(f'data from geoid18: {data}')
-    arcpy.AddMessage(f'N: {n}')
-    arcpy.AddMessage(f'error: {e}')
+    if _VERBOSE:
+        arcpy.AddMessage(f'data from geoid18: {[d.decode() for d in data]}')
+        arcpy.AddMessage(f'N: {n}')
+        arcpy.AddMessage(f'error: {e}')
     return n, e
 
 
+@functools.lru_cache(maxsize=None)
+def fetch_geoid18(lat, long):
+    r"""Request the geoid undulation N from noaa geoid18 calculator
+
+    Used by postprocess_geoid18 and by the transform thread pool fallback,
+    repeat lookups in the same process are served from an lru_cache.
+
+    See:
+    https://geodesy.noaa.gov/GEOID/GEOID18/computation.html
+
+    Arguments:
+        lat: Latitude
+        long: Longitude
+    Returns:
+        Geoid undulation N
+    """
+    r = _SESSION.get(_URL % (lat, long), timeout=(3, 10))
+    if _VERBOSE:
+        arcpy.AddMessage(f'request to noaa geoid18 status: {r.status_code}')
+    r.raise_for_status()
+    return parse_geoid18_response(r.content)[0]
+
+
+async def fetch_geoid18_bytes(session, semaphore, lat, long):
+    r"""Request a point from noaa geoid18 calculator without blocking
+
+    Arguments:
+        session: aiohttp.ClientSession used for the request.
+        semaphore: asyncio.Semaphore limiting the requests in flight.
+        lat: Latitude
+        long: Longitude
+    Returns:
+        Bytes of the html page, parse with parse_geoid18_response
+    """
+    async with semaphore:
+        async with session.get(_URL % (lat, long)) as r:
+            if _VERBOSE:
+                arcpy.AddMessage(f'request to noaa geoid18 status: {r.status}')
+            return await r.read()
+
+
+async def gather_geoid18(coords, max_requests):
+    r"""Request many points from noaa geoid18 calculator
+
+    Arguments:
+        coords: List of (lat, long) tuples.
+        max_requests: Number of requests in flight to noaa geoid18 calculator.
+    Returns:
+        List of html page bytes, or the exception a request raised, in the order of coords
+    """
+    semaphore = asyncio.Semaphore(max_requests)
+    connector = aiohttp.TCPConnector(limit=max_requests)
+    timeout = aiohttp.ClientTimeout(sock_connect=3, sock_read=10)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=True) as session:
+        return await asyncio.gather(*[fetch_geoid18_bytes(session, semaphore, lat, long) for lat, long in coords],
+                                    return_exceptions=True)
+
+
+def event_loop_running():
+    r"""Checks for a running asyncio event loop, as in ArcGIS Pro Notebooks and Jupyter.
+
+    Returns:
+        True if asyncio.run can not be called from this thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def geoid18_cache_key(lat, long):
+    r"""Key for a geoid undulation N in the geoid18 cache
+
+    Arguments:
+        lat: Latitude
+        long: Longitude
+    Returns:
+        The lat and long rounded to 6 decimal places as a string
+    """
+    return f'{round(lat, 6)}_{round(long, 6)}'
+
+
 def postprocess_geoid18(lat, long, h):
     r"""# Postprocess Geoid18 Elevations from Ellipsoid height to Orthometric using noaa geoid18 calculator
+    Kept for single point lookups, transform requests all points together through the geoid18 cache.
     https://geodesy.noaa.gov/GEOID/GEOID18/computation.html
     https://geodesy.noaa.gov/cgi-bin/GEOID_STUFF/geoid18_single.prl?PGM=intg&MODEL=14&LAT=40.050689&LONG=105.281975&longitude_direction=2
 
@@ -145,51 +264,124 @@ def postprocess_geoid18(lat, long, h):
     Returns:
         Orthometric height
     """
-    url = f'https://geodesy.noaa.gov/cgi-bin/GEOID_STUFF/geoid18_single.prl?PGM=intg&MODEL=14&LAT={lat}&LONG={long}&longitude_direction=2'
-    r = requests.get(url)
-    arcpy.AddMessage(f'request to noaa geoid18 status: {r.status_code}')
-    html_file = r.content.decode('UTF-8')
-    n = parse_geoid18_response(html_file)[0]
+    n = fetch_geoid18(lat, long)
     orthometric_height = h - n
-    arcpy.AddMessage(f'Orthometric height, H = h - N, {orthometric_height} = {h} - {n}')
+    if _VERBOSE:
+        arcpy.AddMessage(f'Orthometric height, H = h - N, {orthometric_height} = {h} - {n}')
     return orthometric_height
 
 
-def transform():
+def make_row_builder(passthrough_idx):
+    r"""Compiles a function building an orthometric_R10Points.csv row
+
+    The passthrough column indices are inlined into the generated function so each
+    row is built with a single list display.
+
+    Arguments:
+        passthrough_idx: Indices of the R10Points.csv columns copied to the output row.
+    Returns:
+        A function taking (row, measured_ortho, calculated_ortho) returning the output row list.
+    """
+    items = ''.join(f'row[{int(i)}], ' for i in passthrough_idx)
+    src = f'def _mk(row, measured_ortho, calculated_ortho):\n    return [{items}measured_ortho, calculated_ortho]\n'
+    ns = {}
+    exec(compile(src, '<orthometric_row_builder>', 'exec'), ns)
+    return ns['_mk']
+
+
+# Output row builder for the standard R10Points.csv layout.
+_MAKE_ROW = make_row_builder([_IDX[name] for name in _FIELDNAMES[:-2]])
+
+
+def transform(max_requests=_MAX_REQUESTS):
     """Transforms R10Points.csv
-    Transforms R10Points.csv to orthometric_R10Points.csv using postprocess_geoid18 function
+    Transforms R10Points.csv to orthometric_R10Points.csv using noaa geoid18 calculator, H = h - N
+
+    Geoid undulations are cached in ./Data/.geoid18_cache so only new points are requested.
+    The noaa geoid18 requests are network bound so they are issued concurrently with asyncio
+    and aiohttp. A thread pool is used instead when aiohttp is not installed or an event loop
+    is already running, a max_requests of 1 or less requests them one at a time.
+
+    Arguments:
+        max_requests: Number of requests in flight to noaa geoid18 calculator.
     Returns:
         ./Data/orthometric_R10Points.csv
     """
-    arcpy.AddMessage('Transforming points to orthometric using postprocess_geoid18 function')
+    arcpy.AddMessage('Transforming points to orthometric using noaa geoid18 calculator')
     data_path = set_path(pwd(), 'Data')
     csv_path = set_path(data_path, 'R10Points.csv')
     new_csv_path = set_path(data_path, 'orthometric_R10Points.csv')
+    cache_path = set_path(data_path, '.geoid18_cache')
     rh = 1.55  # the rod height is 1.55 m
-    with open(new_csv_path, 'w', newline='', encoding='utf-8') as f:
-        fieldnames = ['Name', 'Ortho_Measured', 'ReceiverName', 'HorizontalAccuracy', 'VerticalAccuracy',
-                      'Latitude', 'Longitude', 'Elevation', 'NumberSatellites', 'FixTime', 'Measured_Ortho',
-                      'Calculated_Ortho']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        with open(csv_path, 'r') as point_reader:
-            csv_dict = csv.DictReader(point_reader, delimiter=',')
-            for row in csv_dict:
-                lat = float(row.get('Latitude'))
-                long = abs(float(row.get('Longitude')))
-                elev = float(row.get('Elevation'))
-                calculated_ortho = postprocess_geoid18(lat, long, elev)
-                measured_ortho = float(row.get('Ortho_Measured')) - rh
-                row_dict = {'Name': row.get('Name'),
-                            'Ortho_Measured': row.get('Ortho_Measured'), 'ReceiverName': row.get('ReceiverName'),
-                            'HorizontalAccuracy': row.get('HorizontalAccuracy'),
-                            'VerticalAccuracy': row.get('VerticalAccuracy'),
-                            'Latitude': row.get('Latitude'), 'Longitude': row.get('Longitude'),
-                            'Elevation': row.get('Elevation'), 'NumberSatellites': row.get('NumberSatellites'),
-                            'FixTime': row.get('FixTime'), 'Measured_Ortho': measured_ortho,
-                            'Calculated_Ortho': f'{calculated_ortho:0.2f}'}
-                arcpy.AddMessage(f'Writing row to orthometric_R10Points.csv: {row_dict}')
-                writer.writerow(row_dict)
+    with open(csv_path, 'r') as point_reader:
+        # Skip blank lines like csv.DictReader, an empty file gives a header only output.
+        point_csv = (row for row in csv.reader(point_reader, delimiter=',') if row)
+        header = next(point_csv, None)
+        rows = list(point_csv)
+    if header is None or header == list(_FIELDNAMES[:-2]):
+        idx, make_row = _IDX, _MAKE_ROW
+    else:
+        idx = {name: i for i, name in enumerate(header)}
+        make_row = make_row_builder([idx[name] for name in _FIELDNAMES[:-2]])
+    i_lat = idx['Latitude']
+    i_long = idx['Longitude']
+    i_elev = idx['Elevation']
+    i_ortho = idx['Ortho_Measured']
+    lats = [float(row[i_lat]) for row in rows]
+    longs = [abs(float(row[i_long])) for row in rows]
+    keys = [geoid18_cache_key(lat, long) for lat, long in zip(lats, longs)]
+    with shelve.open(cache_path) as cache:
+        misses = {}
+        for key, lat, long in zip(keys, lats, longs):
+            if key not in cache and key not in misses:
+                misses[key] = (lat, long)
+        arcpy.AddMessage(f'geoid18 cache hits: {len(set(keys)) - len(misses)}, misses: {len(misses)}')
+        # Each N is cached as soon as it is known so a failed request does not lose the others.
+        errors = []
+        if max_requests <= 1:
+            for key, (lat, long) in misses.items():
+                try:
+                    cache[key] = fetch_geoid18(lat, long)
+                except Exception as e:
+                    errors.append(e)
+        elif aiohttp is None or event_loop_running():
+            with ThreadPoolExecutor(max_workers=max_requests) as executor:
+                futures = {executor.submit(fetch_geoid18, lat, long): key for key, (lat, long) in misses.items()}
+                for future in as_completed(futures):
+                    try:
+                        cache[futures[future]] = future.result()
+                    except Exception as e:
+                        errors.append(e)
+        else:
+            responses = asyncio.run(gather_geoid18(list(misses.values()), max_requests))
+            for key, html in zip(misses, responses):
+                try:
+                    if isinstance(html, BaseException):
+                        raise html
+                    cache[key] = parse_geoid18_response(html)[0]
+                except Exception as e:
+                    errors.append(e)
+        if errors:
+            arcpy.AddError(f'{len(errors)} of {len(misses)} geoid18 requests failed, the others are cached')
+            raise errors[0]
+        undulations = [cache[key] for key in keys]
+    count = len(rows)
+    elev_arr = np.fromiter((float(row[i_elev]) for row in rows), dtype=np.float64, count=count)
+    om_arr = np.fromiter((float(row[i_ortho]) for row in rows), dtype=np.float64, count=count)
+    n_arr = np.fromiter(undulations, dtype=np.float64, count=count)
+    calc = np.char.mod('%.2f', elev_arr - n_arr).tolist()
+    meas = (om_arr - rh).tolist()
+    with open(new_csv_path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(_FIELDNAMES)
+        batch = []
+        for row, measured_ortho, calculated_ortho in zip(rows, meas, calc):
+            batch.append(make_row(row, measured_ortho, calculated_ortho))
+            if len(batch) == _BATCH_SIZE:
+                writer.writerows(batch)
+                batch.clear()
+        writer.writerows(batch)
+    arcpy.AddMessage(f'Processed {len(rows)} points, wrote to {new_csv_path}')
 
 
 def main():
@@ -209,7 +401,7 @@ def main():
     wd = pwd()
     db = set_path(wd, 'R10FieldMaps.gdb')
     setup_env(db, spatial_ref_dataset)
-    data_path = set_path(pwd(), 'Data')
+    data_path = set_path(wd, 'Data')
     csv_file = set_path(data_path, 'orthometric_R10Points.csv')
     file_name = 'orthometric_R10Points'
 